@@ -1,12 +1,15 @@
-import time
 import pandas as pd
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import yaml
 import sys
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 from playwright.async_api import async_playwright
-from validation import validate_response, validate_expected_data, generate_report
+from validation import build_scoring_config, quantize_encoder, encode_texts, extract_keywords, build_keyword_vocabulary, keyword_mask, is_trivially_dissimilar, validate_response, validate_expected_data, generate_report
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,9 +22,19 @@ config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'c
 # Set headless mode from environment variable, default to False
 headless_mode = os.getenv('HEADLESS_MODE', 'False').lower() in ['true', '1', 'yes']
 
+# Set the number of concurrent chatbot sessions from environment variable, default to 4
+concurrency = max(1, int(os.getenv('CHATBOT_CONCURRENCY', '4')))
+
 with open(config_path, 'r') as file:
     config = yaml.safe_load(file)
 
+# Read the scoring thresholds and weights once instead of on every validation
+scoring = build_scoring_config(config)
+
+# Quantize the embedding model only when enabled, since it changes the reported scores
+if config.get('quantize_encoder', False):
+    quantize_encoder()
+
 async def _login(page, username, password):
     """
     Logs into the chatbot using the provided username and password.
@@ -35,18 +48,24 @@ async def _login(page, username, password):
         Exception: If login fails or any error occurs during the login process.
     """
     try:
-        # Locate login form elements
-        login_form = page.locator("[data-testid='login-flow']")
-        username_field = login_form.locator("input[name='identifier']")
-        password_field = login_form.locator("input[name='password']")
-        submit_button = login_form.locator("button[type='submit']")
-
-        # Input credentials
-        await username_field.fill(username)
-        await password_field.fill(password)
-
-        # Submit login form
-        await submit_button.click()
+        # Wait for the login form to render
+        await page.wait_for_selector("[data-testid='login-flow']")
+
+        # Input credentials and submit the login form in a single round trip. The values are set
+        # through the native setter and announced with input events so the page's framework sees them.
+        await page.evaluate(
+            """([username, password]) => {
+                const form = document.querySelector("[data-testid='login-flow']");
+                const setValue = (input, value) => {
+                    Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set.call(input, value);
+                    input.dispatchEvent(new Event('input', { bubbles: true }));
+                };
+                setValue(form.querySelector("input[name='identifier']"), username);
+                setValue(form.querySelector("input[name='password']"), password);
+                form.querySelector("button[type='submit']").click();
+            }""",
+            [username, password],
+        )
 
         try:
             # Wait for successful login
@@ -58,6 +77,28 @@ async def _login(page, username, password):
         logging.error(f"Error during login: {e}")
         raise
 
+async def _wait_for_stable_response(prose_div, interval=0.25, stable_samples=8, timeout=30):
+    """
+    Waits until the streamed response text is non-empty and stops changing.
+
+    Args:
+        prose_div (Locator): The Playwright locator of the response container.
+        interval (float): The number of seconds between two samples of the response text.
+        stable_samples (int): The number of consecutive identical samples that mark the response as complete.
+        timeout (float): The maximum number of seconds to wait.
+    """
+    previous_text = None
+    unchanged = 0
+    for _ in range(int(timeout / interval)):
+        text = (await prose_div.inner_text()).strip()
+        # An empty reply has not started streaming yet, so it never counts as stable
+        unchanged = unchanged + 1 if text and text == previous_text else 0
+        if unchanged >= stable_samples:
+            return
+        previous_text = text
+        await asyncio.sleep(interval)
+    logging.warning(f"Response still changing after {timeout} seconds, using the latest text")
+
 async def _interact_with_chatbot(page, question):
     """
     Interacts with the chatbot by sending a question and retrieving the response.
@@ -76,16 +117,20 @@ async def _interact_with_chatbot(page, question):
         # Find the input field and send the question
         await page.wait_for_selector('textarea[placeholder="Ask anything!"]')
         input_field = page.locator('textarea[placeholder="Ask anything!"]')
+        previous_responses = await page.locator("div.prose").count()
         await input_field.fill(question)
         await input_field.press("Enter")
-        
-        time.sleep(15)
 
-        # Wait for up to 20 seconds for the response to appear
-        await page.wait_for_selector("div.prose p, div.prose li", timeout=20000)
+        # Wait for up to 20 seconds for a new response to appear
+        await page.wait_for_function(
+            "count => document.querySelectorAll('div.prose').length > count", arg=previous_responses, timeout=20000
+        )
 
-        # Locate all <p> and <li> elements within the last div with class 'prose'
+        # Wait for the new response to finish streaming; replies without <p>/<li> fall back to the sentinel below
         prose_div = page.locator("div.prose").last
+        await _wait_for_stable_response(prose_div)
+
+        # Locate all <p> and <li> elements within the last div with class 'prose'
         all_response_elements = await prose_div.locator("p, li").all()
 
         if all_response_elements:
@@ -102,24 +147,139 @@ async def _interact_with_chatbot(page, question):
         logging.error(f"Error interacting with chatbot: {e}")
         raise
 
-def _write_results(file_path, data, sheet_name):
+async def _ask_questions(browser, username, password, questions, indices, on_response):
+    """
+    Asks a shard of the questions in a dedicated, separately logged-in browser context.
+
+    Args:
+        browser (Browser): The Playwright browser shared by all sessions.
+        username (str): The username for login.
+        password (str): The password for login.
+        questions (list of str): All questions to ask the chatbot.
+        indices (list of int): The indices of the questions handled by this session.
+        on_response (callable): Called with the index of each question and the response text as soon as it arrives.
+
+    Raises:
+        Exception: If any error occurs during the chatbot session.
+    """
+    context = await browser.new_context()
+    try:
+        page = await context.new_page()
+        await page.goto("https://chat.mistral.ai/chat")
+
+        # Login to the chatbot
+        await _login(page, username, password)
+
+        for index in indices:
+            on_response(index, await _interact_with_chatbot(page, questions[index]))
+    except Exception as e:
+        logging.error(f"Error in chatbot session: {e}")
+        raise
+    finally:
+        await context.close()
+
+async def _run_sessions(sessions):
+    """
+    Runs chatbot sessions concurrently and cancels the remaining ones as soon as one fails.
+
+    Args:
+        sessions (list of coroutine): The chatbot sessions to run.
+
+    Raises:
+        Exception: The first error raised by a session, once every other session has stopped.
+    """
+    tasks = [asyncio.create_task(session) for session in sessions]
+    if not tasks:
+        return
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        # Also stop the sessions if we are cancelled ourselves, so none outlives the browser
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    errors = [task.exception() for task in done if not task.cancelled() and task.exception() is not None]
+    if errors:
+        raise errors[0]
+
+def _score_response(question, expected_answer, expected_answer_lower, expected_embedding, expected_keyword_mask, expected_data_item, keyword_vocabulary, response_text):
+    """
+    Validates a single chatbot response against its precomputed expected answer.
+
+    Args:
+        question (str): The question asked to the chatbot.
+        expected_answer (str): The expected answer.
+        expected_answer_lower (str): The lowercased expected answer.
+        expected_embedding (torch.Tensor): The embedding of the expected answer.
+        expected_keyword_mask (int): The keyword bitmask of the expected answer.
+        expected_data_item (str): The data expected in the response.
+        keyword_vocabulary (dict): A mapping from keyword to bit position.
+        response_text (str): The response from the chatbot.
+
+    Returns:
+        dict: The result row for the question.
+    """
+    try:
+        response_lower = response_text.lower()
+        actual_embedding = None
+        if not is_trivially_dissimilar(expected_answer, response_text, scoring):
+            actual_embedding = encode_texts([response_text])[0]
+        actual_keyword_mask = keyword_mask(extract_keywords([response_text])[0], keyword_vocabulary)
+
+        # Validate the response
+        similarity_score, keyword_match, fuzzy_score, fuzzy_match, levenshtein_similarity, combined_score = validate_response(
+            expected_answer_lower, response_lower, expected_embedding, actual_embedding, expected_keyword_mask, actual_keyword_mask, scoring=scoring
+        )
+        expected_data_match = validate_expected_data(expected_data_item, response_lower)
+
+        return {
+            'Question': question,
+            'Actual Answer': response_text,
+            'Expected Answer': expected_answer,
+            'Similarity Score': similarity_score,
+            'Keyword Match': keyword_match,
+            'Fuzzy Score': fuzzy_score,
+            'Fuzzy Match': fuzzy_match,
+            'Levenshtein Similarity': levenshtein_similarity,
+            'Expected Data Match': expected_data_match,
+            'Combined Score': combined_score,
+        }
+    except Exception as e:
+        logging.error(f"Error scoring response: {e}")
+        raise
+
+def _write_results(file_path, sheets):
     """
     Writes the results to an Excel file.
 
+    The workbook is written in openpyxl's write-only mode, which streams rows to the
+    file instead of building every cell in memory.
+
     Args:
         file_path (str): The path to the Excel file.
-        data (list of dict): The data to write to the Excel file.
-        sheet_name (str): The name of the sheet in the Excel file.
+        sheets (dict of str to pd.DataFrame): The data to write, keyed by sheet name.
 
     Raises:
         Exception: If any error occurs during the writing process.
     """
     try:
-        # Create a DataFrame from the results
-        df = pd.DataFrame(data, columns=['Question', 'Actual Answer', 'Expected Answer', 'Similarity Score', 'Keyword Match', 'Fuzzy Score', 'Fuzzy Match', 'Levenshtein Similarity','Expected Data Match', 'Combined Score'])
-        # Write the DataFrame to an Excel file
-        with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+        workbook = Workbook(write_only=True)
+        header_font = Font(bold=True)
+        for sheet_name, df in sheets.items():
+            worksheet = workbook.create_sheet(sheet_name)
+
+            header = []
+            for column in df.columns:
+                cell = WriteOnlyCell(worksheet, value=column)
+                cell.font = header_font
+                header.append(cell)
+            worksheet.append(header)
+
+            # Write missing values as empty cells, like DataFrame.to_excel
+            for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+                worksheet.append(row)
+        workbook.save(file_path)
     except Exception as e:
         logging.error(f"Error writing results to file: {e}")
         raise
@@ -143,49 +303,59 @@ async def main():
         
         # Read questions from Excel
         questions_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data', 'questions.xlsx')
-        questions_df = pd.read_excel(questions_path)
+        questions_df = pd.read_excel(questions_path, engine='calamine', usecols=["Question", "Expected Answer", "Expected Data"])
         questions = questions_df["Question"].tolist()
         expected_answers = questions_df["Expected Answer"].tolist()
         expected_data = questions_df["Expected Data"].tolist()
 
-        results = []
+        # Expected answers are known up front, so encode them and extract their keywords once
+        expected_embeddings = encode_texts(expected_answers)
+        expected_keywords = extract_keywords(expected_answers)
+        keyword_vocabulary = build_keyword_vocabulary(expected_keywords)
+        expected_keyword_masks = [keyword_mask(keywords, keyword_vocabulary) for keywords in expected_keywords]
+        expected_answers_lower = [answer.lower() for answer in expected_answers]
 
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=headless_mode)
-            page = await browser.new_page()
-            await page.goto("https://chat.mistral.ai/chat")
+        loop = asyncio.get_running_loop()
+        validations = [None] * len(questions)
 
-            # Login to the chatbot
-            await _login(page, username, password)
-
-            for question, expected_answer, expected_data_item in zip(questions, expected_answers, expected_data):
-                response_text = await _interact_with_chatbot(page, question)
-
-                # Validate the response
-                similarity_score, keyword_match, fuzzy_score, fuzzy_match, levenshtein_similarity, combined_score = validate_response(expected_answer, response_text, config=config)
-                expected_data_match = validate_expected_data(expected_data_item, response_text)
-
-                results.append({
-                    'Question': question,
-                    'Actual Answer': response_text,
-                    'Expected Answer': expected_answer,
-                    'Similarity Score': similarity_score,
-                    'Keyword Match': keyword_match,
-                    'Fuzzy Score': fuzzy_score,
-                    'Fuzzy Match': fuzzy_match,
-                    'Levenshtein Similarity': levenshtein_similarity,
-                    'Expected Data Match': expected_data_match,
-                    'Combined Score': combined_score,
-                    
-                })
-
-            await browser.close()
+        # Validate each response in a worker thread as soon as it arrives, so the CPU work overlaps
+        # with the next chatbot requests. A single worker keeps model inference serialized.
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            def on_response(index, response_text):
+                validations[index] = loop.run_in_executor(
+                    executor, _score_response, questions[index], expected_answers[index], expected_answers_lower[index],
+                    expected_embeddings[index], expected_keyword_masks[index], expected_data[index], keyword_vocabulary, response_text
+                )
+
+            async with async_playwright() as p:
+                browser = await p.chromium.launch(headless=headless_mode)
+
+                # Spread the questions over concurrent sessions; results are stored by index to keep ordering
+                sessions = min(concurrency, len(questions))
+                await _run_sessions([
+                    _ask_questions(browser, username, password, questions, range(session, len(questions), sessions), on_response)
+                    for session in range(sessions)
+                ])
+
+                await browser.close()
+
+            results = await asyncio.gather(*validations)
+        except BaseException:
+            # Drop the validations of a failed run instead of finishing them
+            for validation in validations:
+                if validation is not None:
+                    validation.cancel()
+            raise
+        finally:
+            # Never block the event loop joining the worker thread
+            executor.shutdown(wait=False, cancel_futures=True)
 
         # Convert results to DataFrame and print or save
-        results_df = pd.DataFrame(results)
+        results_df = pd.DataFrame(results, columns=['Question', 'Actual Answer', 'Expected Answer', 'Similarity Score', 'Keyword Match', 'Fuzzy Score', 'Fuzzy Match', 'Levenshtein Similarity','Expected Data Match', 'Combined Score'])
+        summary_df = generate_report(results_df)
         result_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'reports', 'reports.xlsx')
-        _write_results(result_path, results, sheet_name='Score')
-        generate_report(results_df, output_path=result_path, sheet_name='Metrics')
+        _write_results(result_path, {'Score': results_df, 'Metrics': summary_df})
     except Exception as e:
         logging.error(f"Error in main function: {e}")
         raise
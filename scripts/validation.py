@@ -1,36 +1,116 @@
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+import torch
 import spacy
+from spacy.attrs import LEMMA, IS_STOP, IS_PUNCT, LENGTH
+import numpy as np
 import pandas as pd
-from fuzzywuzzy import fuzz
+from rapidfuzz.distance import Levenshtein
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
-import Levenshtein
 import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
 
 # Set up logging
 logging.basicConfig(filename='model_output.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Initialize SpaCy and SentenceTransformer
-nlp = spacy.load('en_core_web_sm')
+# Only the lemmatizer and its tagger dependencies are needed for keyword extraction
+nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner'])
 model = SentenceTransformer('all-MiniLM-L6-v2')
+model.eval()
 
-def _calculate_similarity(text1, text2):
+# Embeddings of recently encoded texts, so repeated answers are only encoded once
+EMBEDDING_CACHE_SIZE = 4096
+_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+class ScoringConfig(NamedTuple):
+    """
+    Thresholds and weights used to score a response, read once from the configuration.
+    """
+    similarity_weight: float
+    keyword_match_weight: float
+    fuzzy_match_weight: float
+    levenshtein_similarity_weight: float
+    weight_sum: float
+    keyword_match_threshold: float
+    fuzzy_match_threshold: float
+    prefilter_length_ratio: float
+
+def build_scoring_config(config):
     """
-    Calculate the cosine similarity between two texts using SentenceTransformer.
+    Build the scoring configuration from the configuration dictionary.
 
     Args:
-        text1 (str): The first text.
-        text2 (str): The second text.
+        config (dict): Configuration dictionary containing thresholds and weights.
 
     Returns:
-        float: The cosine similarity score.
+        ScoringConfig: The thresholds and weights used by validate_response.
+    """
+    weights = config['weights']
+    return ScoringConfig(
+        similarity_weight=weights['similarity'],
+        keyword_match_weight=weights['keyword_match'],
+        fuzzy_match_weight=weights['fuzzy_match'],
+        levenshtein_similarity_weight=weights['levenshtein_similarity'],
+        weight_sum=sum(weights.values()),
+        keyword_match_threshold=config['keyword_match_threshold'],
+        fuzzy_match_threshold=config['fuzzy_match_threshold'],
+        prefilter_length_ratio=config.get('prefilter_length_ratio', 0),
+    )
+
+def quantize_encoder():
+    """
+    Quantize the SentenceTransformer's Linear layers to dynamic int8.
+
+    This speeds up encoding on CPU but changes the reported Similarity and Combined
+    scores, so it is only applied when enabled in the configuration. Dynamic int8
+    kernels are CPU-only, so a model loaded on a GPU is left unchanged.
+    """
+    if model.device.type != 'cpu':
+        logging.warning("Encoder quantization is only supported on CPU, keeping the float model")
+        return
+    model[0].auto_model = torch.ao.quantization.quantize_dynamic(model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8)
+    # Embeddings from the float model are no longer comparable
+    with _embedding_cache_lock:
+        _embedding_cache.clear()
+
+def encode_texts(texts):
+    """
+    Encode texts into normalized embeddings using SentenceTransformer.
+
+    The embeddings are normalized, so the cosine similarity of two of them reduces
+    to a dot product. Embeddings are kept in an LRU cache, and only the distinct
+    texts missing from it are encoded, in a single batch.
+
+    Args:
+        texts (list of str): The texts to encode.
+
+    Returns:
+        torch.Tensor: The embeddings, one row per text.
     """
     try:
-        embeddings1 = model.encode(text1, convert_to_tensor=True)
-        embeddings2 = model.encode(text2, convert_to_tensor=True)
-        similarity = util.pytorch_cos_sim(embeddings1, embeddings2)
-        return similarity.item()  # Return a single scalar value (float)
+        # Inference only, so skip autograd and version-counter bookkeeping entirely
+        with _embedding_cache_lock, torch.inference_mode():
+            missing = [text for text in dict.fromkeys(texts) if text not in _embedding_cache]
+            if missing:
+                embeddings = model.encode(missing, batch_size=64, convert_to_tensor=True, normalize_embeddings=True, show_progress_bar=False)
+                _embedding_cache.update(zip(missing, embeddings))
+
+            rows = []
+            for text in texts:
+                _embedding_cache.move_to_end(text)
+                rows.append(_embedding_cache[text])
+            # Evict only after collecting the rows, so a batch larger than the cache still resolves
+            while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+                _embedding_cache.popitem(last=False)
+
+            if not rows:
+                return torch.empty((0, model.get_sentence_embedding_dimension()))
+            return torch.stack(rows)
     except Exception as e:
-        logging.error(f"Error calculating similarity: {e}")
+        logging.error(f"Error encoding texts: {e}")
         raise
 
 def _calculate_levenshtein_similarity(text1, text2):
@@ -45,112 +125,173 @@ def _calculate_levenshtein_similarity(text1, text2):
         float: The Levenshtein similarity score.
     """
     try:
-        distance = Levenshtein.distance(text1, text2)
-        similarity = 1 - (distance / max(len(text1), len(text2)))
-        return similarity
+        # Equivalent to 1 - distance / max(len(text1), len(text2)), in a single bit-parallel pass
+        return Levenshtein.normalized_similarity(text1, text2)
     except Exception as e:
         logging.error(f"Error calculating Levenshtein similarity: {e}")
         raise
 
-def _extract_keywords(text):
+def extract_keywords(texts):
     """
-    Extract keywords from a given text using SpaCy.
+    Extract keywords from the given texts using SpaCy.
 
     Args:
-        text (str): The text from which to extract keywords.
+        texts (list of str): The texts from which to extract keywords.
 
     Returns:
-        set: A set of keywords.
+        list of set: A set of keywords for each text.
     """
     try:
-        doc = nlp(text)
-        keywords = set([
-            token.lemma_.lower() for token in doc
-            if not token.is_stop and not token.is_punct and len(token) > 1
-        ])
+        keywords = []
+        for doc in nlp.pipe(texts, batch_size=64):
+            # Filter tokens on one attribute array instead of per-token attribute access
+            attributes = doc.to_array([LEMMA, IS_STOP, IS_PUNCT, LENGTH])
+            keep = (attributes[:, 1] == 0) & (attributes[:, 2] == 0) & (attributes[:, 3] > 1)
+            # Resolve each distinct lemma hash to its string only once
+            keywords.append(set(doc.vocab.strings[lemma].lower() for lemma in np.unique(attributes[keep, 0]).tolist()))
         return keywords
     except Exception as e:
         logging.error(f"Error extracting keywords: {e}")
         raise
 
-def validate_response(expected_answer, actual_response, config):
+def build_keyword_vocabulary(expected_keywords):
     """
-    Validate the response by calculating various similarity metrics.
+    Assign a bit position to every keyword of the expected answers.
+
+    Keywords that only occur in actual responses can never count towards a keyword
+    match, so the expected answers alone define the vocabulary.
+
+    Args:
+        expected_keywords (list of set): The keywords of each expected answer, see extract_keywords.
+
+    Returns:
+        dict: A mapping from keyword to bit position.
+    """
+    vocabulary = {}
+    for keywords in expected_keywords:
+        for keyword in keywords:
+            vocabulary.setdefault(keyword, len(vocabulary))
+    return vocabulary
+
+def keyword_mask(keywords, vocabulary):
+    """
+    Encode a keyword set as an integer bitmask over the keyword vocabulary.
+
+    Args:
+        keywords (set): The keywords to encode, see extract_keywords.
+        vocabulary (dict): A mapping from keyword to bit position, see build_keyword_vocabulary.
+
+    Returns:
+        int: The bitmask with the bit of every known keyword set.
+    """
+    mask = 0
+    for keyword in keywords:
+        if keyword in vocabulary:
+            mask |= 1 << vocabulary[keyword]
+    return mask
+
+def is_trivially_dissimilar(expected_answer, actual_response, scoring):
+    """
+    Check whether a response is so different in length from the expected answer that
+    computing the similarity metrics is not worth it.
 
     Args:
         expected_answer (str): The expected answer.
         actual_response (str): The actual response.
-        config (dict): Configuration dictionary containing thresholds and weights.
+        scoring (ScoringConfig): The scoring configuration, see build_scoring_config.
+
+    Returns:
+        bool: True if the pair should be scored as dissimilar without further checks.
+    """
+    shorter, longer = sorted((len(expected_answer), len(actual_response)))
+    return longer > 0 and shorter / longer < scoring.prefilter_length_ratio
+
+def validate_response(expected_answer_lower, actual_response_lower, expected_embedding, actual_embedding, expected_keywords, actual_keywords, scoring):
+    """
+    Validate the response by calculating various similarity metrics.
+
+    Args:
+        expected_answer_lower (str): The lowercased expected answer.
+        actual_response_lower (str): The lowercased actual response.
+        expected_embedding (torch.Tensor): The embedding of the expected answer, see encode_texts.
+        actual_embedding (torch.Tensor): The embedding of the actual response, see encode_texts,
+            or None if the pair was prefiltered, see is_trivially_dissimilar.
+        expected_keywords (int): The keyword bitmask of the expected answer, see keyword_mask.
+        actual_keywords (int): The keyword bitmask of the actual response, see keyword_mask.
+        scoring (ScoringConfig): The scoring configuration, see build_scoring_config.
 
     Returns:
         tuple: A tuple containing similarity scores and match indicators.
     """
     try:
-        # Extract keywords for single text pairs
-        actual_keywords = _extract_keywords(actual_response)
-        expected_keywords = _extract_keywords(expected_answer)
+        # Compute keyword match
+        keyword_match = (expected_keywords & actual_keywords).bit_count() / expected_keywords.bit_count() >= scoring.keyword_match_threshold
 
-        # Calculate similarity score for the pair using BERT-based similarity
-        similarity_score = _calculate_similarity(expected_answer, actual_response)
+        if actual_embedding is None:
+            # Prefiltered pair, skip the expensive metrics
+            similarity_score, fuzzy_score, levenshtein_similarity = 0.0, 0, 0.0
+        else:
+            # Calculate similarity score for the pair using BERT-based similarity
+            similarity_score = (expected_embedding * actual_embedding).sum().item()
 
-        # Compute keyword match
-        keyword_match = len(expected_keywords.intersection(actual_keywords)) / len(expected_keywords) >= config['keyword_match_threshold']
+            # Levenshtein similarity, also reported as the fuzzy score on a 0-100 integer scale
+            levenshtein_similarity = _calculate_levenshtein_similarity(expected_answer_lower, actual_response_lower)
+            fuzzy_score = round(levenshtein_similarity * 100)
 
         # Fuzzy match
-        fuzzy_score = fuzz.ratio(expected_answer.lower(), actual_response.lower())
-        fuzzy_match = fuzzy_score >= config['fuzzy_match_threshold']
-
-        # Levenshtein similarity
-        levenshtein_similarity = _calculate_levenshtein_similarity(expected_answer, actual_response)
+        fuzzy_match = fuzzy_score >= scoring.fuzzy_match_threshold
 
         # Combined score using weighted average
         combined_score = (
-            (similarity_score * config['weights']['similarity']) +
-            (keyword_match * config['weights']['keyword_match']) +
-            (fuzzy_match * config['weights']['fuzzy_match']) +
-            (levenshtein_similarity * config['weights']['levenshtein_similarity'])
-        ) / sum(config['weights'].values())
+            (similarity_score * scoring.similarity_weight) +
+            (keyword_match * scoring.keyword_match_weight) +
+            (fuzzy_match * scoring.fuzzy_match_weight) +
+            (levenshtein_similarity * scoring.levenshtein_similarity_weight)
+        ) / scoring.weight_sum
 
         return similarity_score, keyword_match, fuzzy_score, fuzzy_match, levenshtein_similarity, combined_score
     except Exception as e:
         logging.error(f"Error validating response: {e}")
         raise
 
-def validate_expected_data(expected_data, actual_response):
+def validate_expected_data(expected_data, actual_response_lower):
     """
     Validate if the expected data is present in the actual response.
 
     Args:
         expected_data (str): The expected data.
-        actual_response (str): The actual response.
+        actual_response_lower (str): The lowercased actual response.
 
     Returns:
         bool: True if expected data is in the actual response, False otherwise.
     """
     try:
-        # Ensure both expected_data and actual_response are strings
+        # Ensure expected_data is a string
         expected_data = str(expected_data).lower()
-        actual_response = str(actual_response).lower()
 
         # Check if expected data is in the actual response
-        return expected_data in actual_response
+        return expected_data in actual_response_lower
     except Exception as e:
         logging.error(f"Error validating expected data: {e}")
         raise
 
-def generate_report(results_df, output_path, sheet_name):
+def generate_report(results_df):
     """
     Generate a report with accuracy, precision, recall, and F1-score.
 
     Args:
         results_df (pd.DataFrame): A DataFrame containing validation results.
-        output_path (str): The path to the output Excel file.
-        sheet_name (str): The name of the sheet in the Excel file.
+
+    Returns:
+        pd.DataFrame: A DataFrame with one row per metric.
     """
     try:
         # Convert match criteria to binary labels
-        actual_labels = [1 if row['Keyword Match'] and row['Fuzzy Match'] and row['Expected Data Match'] else 0 for row in results_df.to_dict('records')]
-        predicted_labels = [1 if row['Keyword Match'] or row['Fuzzy Match'] or row['Expected Data Match'] else 0 for row in results_df.to_dict('records')]
+        keyword_match = results_df['Keyword Match'].to_numpy(dtype=bool)
+        fuzzy_match = results_df['Fuzzy Match'].to_numpy(dtype=bool)
+        expected_data_match = results_df['Expected Data Match'].to_numpy(dtype=bool)
+        actual_labels = (keyword_match & fuzzy_match & expected_data_match).astype(np.int8)
+        predicted_labels = (keyword_match | fuzzy_match | expected_data_match).astype(np.int8)
 
         # Calculate metrics - Might be used for different self developed bot
         accuracy = accuracy_score(actual_labels, predicted_labels)
@@ -159,13 +300,10 @@ def generate_report(results_df, output_path, sheet_name):
         f1 = f1_score(actual_labels, predicted_labels, zero_division=0)
 
         # Prepare summary DataFrame
-        summary_df = pd.DataFrame({
+        return pd.DataFrame({
             "Metric": ["Accuracy", "Precision", "Recall", "F1-Score"],
             "Value": [accuracy, precision, recall, f1]
         })
-
-        with pd.ExcelWriter(output_path, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-            summary_df.to_excel(writer, sheet_name=sheet_name, index=False)
     except Exception as e:
         logging.error(f"Error generating report: {e}")
         raise